@@ -1,21 +1,106 @@
 # This script will mass download soundtracks of an album from downloads.khinsider.com
 # Built-in dependencies
-from os.path import isfile
-from os import mkdir
+from codecs import lookup
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+from functools import lru_cache, partial
+from io import BytesIO
+from os.path import isdir, isfile
+from os import makedirs
 from pathlib import Path
-from typing import Tuple, Sequence
-from urllib.parse import unquote
+from threading import Lock
+from shutil import copyfileobj
+from typing import List, Optional, Tuple, Sequence
+from urllib.parse import quote, unquote, urlsplit, urlunsplit
 
 # External dependencies
-from requests import get
+from requests import Response
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
-from bs4 import BeautifulSoup
+from requests_cache import CachedSession, DO_NOT_CACHE
+from urllib3.util.retry import Retry
+import lxml.html
+from lxml import etree
 from tqdm import tqdm
+from tqdm.utils import CallbackIOWrapper
 
 # URL to album
 BASE_URL = 'https://downloads.khinsider.com'
 BASE_ALBUM_URL = f'{BASE_URL}/game-soundtracks/album'
 
+# Default parent directory of downloaded albums
+HOME_MUSIC = f'{Path.home()}/Music/'
+
+# Units used to display file sizes
+BYTE_UNITS = ('B', 'KB', 'MB', 'GB')
+
+# Number of soundtrack pages scraped and soundtracks downloaded at the same time
+MAX_SCRAPE_WORKERS = 16
+MAX_DOWNLOAD_WORKERS = 8
+
+# Shared HTTP session, so every request to khinsider reuses the same keep-alive connections
+# instead of doing a new TCP + TLS handshake each time. It is created on first use by get_session().
+_SESSION = None
+_SESSION_LOCK = Lock()
+
+# Audio files are requested uncompressed, so the size reported by a HEAD request is the number of bytes written
+AUDIO_HEADERS = {'Accept-Encoding': 'identity'}
+
+
+def get_session() -> CachedSession:
+    """
+    Returns the shared HTTP session, creating it on the first call.
+    Album and soundtrack pages are cached on disk for an hour, so re-running on the same album doesn't fetch them again.
+    Anything else (the audio files, whose URLs are short-lived) is never cached.
+    The session is created lazily because it opens the cache file (khinsider_cache.sqlite in the user's cache
+    directory), so that importing this module has no side effect on disk.
+
+    Returns:
+        CachedSession: The shared HTTP session.
+    """
+    global _SESSION
+    # Soundtracks are scraped and downloaded from several threads, make sure only one of them creates the session
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = CachedSession(
+                'khinsider_cache',
+                use_cache_dir=True,
+                backend='sqlite',
+                expire_after=3600,
+                allowable_codes=(200,),
+                allowable_methods=('GET',),
+                urls_expire_after={
+                    'downloads.khinsider.com/game-soundtracks/album/*': 3600,
+                    '*': DO_NOT_CACHE,
+                },
+            )
+            session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                                  max_retries=Retry(total=3, backoff_factor=0.3)))
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _SESSION = session
+        return _SESSION
+
+
+def get_declared_charset(response: Response) -> Optional[str]:
+    """
+    Returns the charset declared in the Content-Type header of a response, if any.
+    Unlike `response.encoding`, this doesn't fall back to ISO-8859-1 for text responses without a charset,
+    so lxml can still read the charset from the page itself (BOM or meta tag) in that case.
+
+    Args:
+        response (requests.Response): The response of an HTML page.
+
+    Returns:
+        Optional[str]: The declared charset, or None if the header doesn't declare a known one.
+    """
+    message = Message()
+    message['Content-Type'] = response.headers.get('Content-Type', '')
+    charset = message.get_content_charset()
+    try:
+        return charset and lookup(charset).name
+    except LookupError:
+        return None
+
 
 def get_input(prompt: str, default: str = None) -> str:
     """
@@ -86,11 +171,9 @@ def choose_download_dir(dir_default: str):
         out = str(get_input(f'▶ Download location (Press Enter to use default: {dir_default} ):\n', default=dir_default))
 
         try:
-            mkdir(out)
+            makedirs(out, exist_ok=True)
             return out
-        except FileExistsError:
-            return out
-        except PermissionError as err:
+        except OSError as err:
             print(err)
             print('Invalid location: Please provide a valid download location or use default.\n')
 
@@ -106,18 +189,12 @@ def format_bytes(bytes_list):
         A list of formatted sizes in human-readable units (B, KB, MB, GB).
     """
     max_bytes = max(bytes_list)
-    unit_dict = {
-        0: 'B',
-        1: 'KB',
-        2: 'MB',
-        3: 'GB'
-    }
-    index = 0
-    while max_bytes >= 1000:
-        index += 1
-        max_bytes /= 1000
-    unit = unit_dict.get(index)
-    return [f'{b / (1024 ** index):.1f} {unit}' for b in bytes_list]
+
+    # Every unit is 1024 (2 ** 10) times the previous one, so the bit length of the largest size picks the unit
+    index = min(max(max_bytes.bit_length() - 1, 0) // 10, len(BYTE_UNITS) - 1)
+    unit = BYTE_UNITS[index]
+    divisor = 1024 ** index
+    return [f'{b / divisor:.1f} {unit}' for b in bytes_list]
 
 
 class KhinsiderAlbum:
@@ -133,56 +210,97 @@ class KhinsiderAlbum:
         """
         self.album_url = f'{BASE_ALBUM_URL}/{album_id}'
 
-        # Make a request to the album page URL and parse the HTML with BeautifulSoup.
-        html = get(self.album_url)
-
-        album_page = BeautifulSoup(html.text, 'html.parser')
+        # Make a request to the album page URL and parse the HTML with lxml.
+        # The raw bytes are parsed with the charset declared by the server, or, if there is none,
+        # the one lxml finds in the page (BOM or meta tag), instead of requests guessing it to decode
+        # the whole page into text first.
+        response = get_session().get(self.album_url)
 
-        # Get the album title.
-        album_title = album_page.find('h2').text
+        # Get the album title and the soundtracks table
+        album_title, soundtracks_table = self._parse_album_page(response.content, get_declared_charset(response))
 
         if album_title == 'Ooops!':
             raise ConnectionRefusedError(f"Invalid ID: Album ID '{album_id}' doesn't exist")
 
-        # Get the soundtracks table
-        soundtracks_table = album_page.find_all('table')[1]
-        th_list = soundtracks_table.find_all('th')
+        # Read the text of every th element once
+        th_texts = [''.join(th.itertext()).strip() for th in soundtracks_table.iter('th')]
 
         # Finds the index of the MP3 format in the th element
-        mp3_index = next(i for i, th in enumerate(th_list) if th.text == 'MP3')
+        mp3_index = th_texts.index('MP3')
         album_formats = []
 
         # Finds all available audio format starting from MP3...
-        for i in range(mp3_index, len(th_list)):
+        for f in th_texts[mp3_index:]:
             # If content of current th element is not empty,
             # it means the content talks about the audio format available.
             # Otherwise, it means the talk about audio format(s) has ended,
             # thus stop looping other elements to enhance performance.
-            if f := th_list[i].text.strip():
+            if f:
                 album_formats.append(f)
             else:
                 break
 
         # Extract the duration of the album and the spaces requirements for each format
         # This is obtained from th elements at the endmost of the soundtracks table
-        album_duration, *sizes = tuple(map(lambda th: th.text, th_list[-(len(album_formats) + 2):-1]))
+        album_duration, *sizes = th_texts[-(len(album_formats) + 2):-1]
 
         # Parse the amount of size from its unit (MB) and convert it to bytes (1 MB = 1,000,000 B)
         # Example: "10 MB" (str) -> 10_000_000 (int)
-        sizes = list(map(lambda s: int(s.split(' ')[0].replace(',', '')) * 1_000_000, sizes))
-        sizes = format_bytes(sizes)
+        sizes = format_bytes([int(s.split(' ', 1)[0].replace(',', '')) * 1_000_000 for s in sizes])
 
         album_formats_and_sizes = tuple(zip(album_formats, sizes))
 
-        # Get the URLs to each soundtrack's source page
-        urls = [td for i, td in enumerate(soundtracks_table.find_all_next('td', class_='clickable-row')) if i % 4 == 0]
-        soundtrack_urls = list(map(lambda td: f"{BASE_URL}{td.next_element['href']}", urls))
+        # Get the URLs to each soundtrack's source page (the link in the first clickable cell of every row)
+        hrefs = soundtracks_table.xpath(
+            ".//tr/td[contains(concat(' ', normalize-space(@class), ' '), ' clickable-row ')][1]/a/@href")
+        soundtrack_urls = [BASE_URL + href for href in hrefs]
 
         self.title = album_title
         self.duration = album_duration
         self.formats_and_sizes = album_formats_and_sizes
         self.soundtrack_urls = soundtrack_urls
 
+    @staticmethod
+    def _parse_album_page(content: bytes,
+                          encoding: Optional[str] = None) -> Tuple[Optional[str], Optional[etree._Element]]:
+        """
+        Stream-parse an album page up to its soundtracks table (the second table of the page).
+        Parsing stops right after that table, and the tables before it are cleared once parsed,
+        so the rest of the page is never loaded into memory.
+
+        Args:
+            content (bytes): The HTML of the album page.
+            encoding (str, optional): The charset of the page. Defaults to None (read from the page itself).
+
+        Returns:
+            Tuple[Optional[str], Optional[lxml.etree._Element]]: The album title (text of the first h2 element)
+                and the soundtracks table, or None for either if the page doesn't have it.
+        """
+        album_title = None
+        soundtracks_table = None
+        table_count = 0
+
+        for event, element in etree.iterparse(BytesIO(content), events=('start', 'end'), tag=('h2', 'table'),
+                                              html=True, encoding=encoding):
+            # Count tables by their opening tag, so they are numbered in document order like (//table)[2]
+            if event == 'start':
+                if element.tag == 'table':
+                    table_count += 1
+                    if table_count == 2:
+                        soundtracks_table = element
+                continue
+
+            if element.tag == 'h2':
+                if album_title is None:
+                    album_title = ''.join(element.itertext())
+            elif element is soundtracks_table:
+                break
+            elif soundtracks_table is None:
+                # Tables before the soundtracks table aren't needed
+                element.clear()
+
+        return album_title, soundtracks_table
+
     def __str__(self):
         """
         Return a formatted string representation of the KhinsiderAlbum object.
@@ -223,6 +341,22 @@ class KhinsiderAlbum:
             return url_to_album.rsplit('/', 1)[1]
         return url_to_album
 
+    @staticmethod
+    @lru_cache
+    def _download_link_xpath(audio_select: int) -> etree.XPath:
+        """
+        Compile the XPath selecting the download URL of the chosen audio format on a soundtrack webpage.
+        The compiled XPath is cached, so it is built once per format and reused for every soundtrack.
+
+        Args:
+            audio_select (int): The index of the audio format (0 is the first download link on the page).
+
+        Returns:
+            lxml.etree.XPath: A callable returning a list with the download URL, or an empty list if there is none.
+        """
+        return etree.XPath(f"(//*[contains(concat(' ', normalize-space(@class), ' '), ' songDownloadLink ')])"
+                           f"[{audio_select + 1}]/parent::*/@href")
+
     @staticmethod
     def _scrape_download_url(soundtrack_url: str, audio_select: int = 0) -> str:
         """
@@ -238,21 +372,24 @@ class KhinsiderAlbum:
 
         Raises:
             requests.exceptions.RequestException: If there is an error with the HTTP request.
-            ValueError: If the audio_format_selection parameter is out of range.
+            IndexError: If the audio_select parameter is out of range.
 
         """
-        # Open source page
-        html = get(soundtrack_url)
-        soundtrack_page = BeautifulSoup(html.text, 'html.parser')
+        # Open source page (parse the raw bytes with the declared charset, see __init__)
+        response = get_session().get(soundtrack_url)
+        parser = lxml.html.HTMLParser(encoding=get_declared_charset(response))
+        soundtrack_page = lxml.html.fromstring(response.content, parser=parser)
 
         # Scrape the link to download resource
-        download_url = soundtrack_page.find_all(class_='songDownloadLink')[audio_select].parent['href']
-
-        # The website's url already formatted some characters to their corresponding code (%XX)
-        # Unquote will reformat it from code back to its original character
-        # Refer https://docs.python.org/3.10/library/urllib.parse.html#urllib.parse.unquote
-        # The '#' special character is used in certain URLs (in the filename), replace for URL purpose
-        download_url = unquote(download_url).replace('#', '%23')
+        download_url = KhinsiderAlbum._download_link_xpath(audio_select)(soundtrack_page)[0]
+
+        # The website's url only formatted some characters to their corresponding code (%XX)
+        # Unquote then quote the path again so every special character of the filename is encoded,
+        # such as '#', '?' or '&', which would otherwise end the path of the URL.
+        # The URL isn't split on '#', as a '#' left unformatted by the website is part of the filename.
+        # Refer https://docs.python.org/3.10/library/urllib.parse.html#urllib.parse.quote
+        url_parts = urlsplit(download_url, allow_fragments=False)
+        download_url = urlunsplit(url_parts._replace(path=quote(unquote(url_parts.path), safe='/')))
         return download_url
 
     @staticmethod
@@ -271,25 +408,70 @@ class KhinsiderAlbum:
             >>> KhinsiderAlbum._parse_filename(url)
             '#1 Track 1.mp3'
         """
-        return download_url.rsplit('/', 1)[1].replace('%23', '#')
+        return unquote(urlsplit(download_url).path.rsplit('/', 1)[1])
 
     @staticmethod
-    def _download_soundtrack(download_url, filepath):
+    def _get_content_length(download_url: str) -> int:
+        """
+        Returns the size in bytes of the file at the given URL, as reported by a HEAD request (0 if unknown).
+        """
+        # The size only feeds the progress bar, so a failed request mustn't stop the download
+        try:
+            response = get_session().head(download_url, headers=AUDIO_HEADERS, allow_redirects=True)
+        except RequestException:
+            return 0
+        return int(response.headers.get('content-length', 0))
+
+    @staticmethod
+    def _download_soundtrack(download_url: str, filepath: str, progress_bar: tqdm) -> None:
         # Make a GET request to the URL, but don't download the entire response at once
-        response = get(download_url, stream=True)
+        response = get_session().get(download_url, headers=AUDIO_HEADERS, stream=True)
 
-        total_size_in_bytes = int(response.headers.get('content-length', 0))
-        block_size = 500_000  # 0.5 MB
+        block_size = 1024 * 1024  # 1 MiB
 
-        progress_bar = tqdm(total=total_size_in_bytes, unit='it', unit_scale=True, colour='green')
+        # The progress bar is shared by every download thread, so update it while holding its lock
+        def update(n):
+            with tqdm.get_lock():
+                progress_bar.update(n)
 
-        # Open a file to write the downloaded data to
+        # Let urllib3 undo any transfer encoding the server applies anyway, then copy the raw stream into the file
+        response.raw.decode_content = True
         with open(filepath, 'wb') as file:
-            for data in response.iter_content(block_size):
-                progress_bar.update(len(data))
-                file.write(data)
+            copyfileobj(CallbackIOWrapper(update, response.raw, 'read'), file, length=block_size)
+
+    @staticmethod
+    def _try_scrape_download_url(soundtrack_url: str, audio_select: int = 0) -> Optional[str]:
+        """
+        Same as `_scrape_download_url`, but reports a failure instead of raising it, so one soundtrack page
+        can't abort the whole album.
+
+        Returns:
+            Optional[str]: The URL of the audio file to download, or None if it couldn't be scraped.
+        """
+        try:
+            return KhinsiderAlbum._scrape_download_url(soundtrack_url, audio_select)
+        except IndexError:
+            print(f'Skipping {soundtrack_url}, the chosen format is not available...')
+        except RequestException as err:
+            print(f'Skipping {soundtrack_url}, {err}...')
+        return None
+
+    @staticmethod
+    def resolve_source_urls(page_urls: Sequence[str], audio_format_selection: int = 0) -> List[Optional[str]]:
+        """
+        Scrape the download URLs of the audio files from several soundtrack webpages concurrently.
 
-        progress_bar.close()
+        Args:
+            page_urls (Sequence[str]): The URLs of the soundtrack webpages.
+            audio_format_selection (int, optional): The index of the desired audio format. Defaults to 0.
+
+        Returns:
+            List[Optional[str]]: The URLs of the audio files to download, in the same order as `page_urls`.
+                None for a page whose download URL couldn't be scraped.
+        """
+        scrape = partial(KhinsiderAlbum._try_scrape_download_url, audio_select=audio_format_selection)
+        with ThreadPoolExecutor(max_workers=MAX_SCRAPE_WORKERS) as executor:
+            return list(executor.map(scrape, page_urls))
 
     @staticmethod
     def _create_output_directory(directory):
@@ -302,11 +484,9 @@ class KhinsiderAlbum:
         Returns:
             None.
         """
-        try:
-            mkdir(directory)
+        if not isdir(directory):
+            makedirs(directory, exist_ok=True)
             print(f'Directory {directory} created...')
-        except FileExistsError:
-            pass
 
     def download(self, out_dir: str, audio_format_selection: int) -> None:
         """
@@ -322,24 +502,47 @@ class KhinsiderAlbum:
         :return: None
         """
         self._create_output_directory(out_dir)
-        download_count = 0
+
+        # Resolve every download URL first, so the page scrapes don't hold back the downloads one round-trip at a time
+        download_urls = self.resolve_source_urls(self.soundtrack_urls, audio_format_selection)
+
+        download_urls_and_paths = []
+        queued_filepaths = set()
         skip_count = 0
-        for url in self.soundtrack_urls:
-            download_url = self._scrape_download_url(url, audio_format_selection)
+        for download_url in download_urls:
+            # The soundtrack page couldn't be scraped, it has already been reported
+            if download_url is None:
+                skip_count += 1
+                continue
+
             filename = self._parse_filename(download_url)
             filepath = f'{out_dir}/{filename}'
 
-            # Checks if file already exists
-            if isfile(filepath):
+            # Checks if file already exists, or is already going to be downloaded by another soundtrack
+            # (two threads writing the same file would overwrite each other)
+            if isfile(filepath) or filepath in queued_filepaths:
                 print(f'Skipping {filename}, it already exists...')
                 skip_count += 1
                 continue
 
-            print(f'Downloading {filename}...')
+            queued_filepaths.add(filepath)
+            download_urls_and_paths.append((download_url, filepath))
+
+        download_count = len(download_urls_and_paths)
+        if download_urls_and_paths:
+            urls, paths = zip(*download_urls_and_paths)
+
+            # Soundtracks are independent of each other, so download several of them at once over the shared session
+            with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+                # Ask for the size of every file beforehand, so the progress bar shows the total of the whole download
+                total_size_in_bytes = sum(executor.map(self._get_content_length, urls))
 
-            self._download_soundtrack(download_url, filepath)
+                # Redraw at most every 0.25 s or 256 KiB
+                with tqdm(total=total_size_in_bytes, unit='B', unit_scale=True, colour='green',
+                          mininterval=0.25, miniters=1024 * 256) as progress_bar:
+                    download = partial(self._download_soundtrack, progress_bar=progress_bar)
+                    list(executor.map(download, urls, paths))
 
-            download_count += 1
         print(f'Downloads finished! {download_count} files have been downloaded, {skip_count} files has been skipped.')
 
     def get_download_length(self):
@@ -382,7 +585,7 @@ if __name__ == '__main__':
             print('')
 
             # Preset the output directory of audio file
-            dir_out = choose_download_dir(f'{str(Path.home())}/Music/{khin_album.title}')
+            dir_out = choose_download_dir(HOME_MUSIC + khin_album.title)
 
             # Inform the user that the download is being prepared
             print('\nPreparing download...')